@@ -1,22 +1,32 @@
 from __future__ import annotations
 from urllib.parse import quote
 from dataclasses import dataclass
-from typing import Iterable, Union
-import json
+from pathlib import Path
+from typing import Callable, Iterable, TypeVar, Union
+import ahocorasick
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from httpx import HTTPStatusError, HTTPError, TimeoutException
 import unittest
 import httpx
+import os
 import re
-import difflib
-import time
-from functools import cache, total_ordering
+import tenacity
+from functools import lru_cache
+from operator import attrgetter
 from bs4 import BeautifulSoup
 from rich.progress import track, Progress
 from rich.console import Console
-import cattr
+from cattrs import Converter
+from cattrs.gen import make_dict_structure_fn
+import orjson
+from rapidfuzz import fuzz, process
 
 console = Console(stderr=True)
 
+T = TypeVar("T")
+
 
 IMPERSONATE_HEADERS = {
     "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36",
@@ -34,6 +44,24 @@ IMPERSONATE_HEADERS = {
     "upgrade-insecure-requests": "1",
 }
 
+# Shared client so that connections to the Shimano hosts are kept alive and reused.
+# The transport retries failed connection attempts on its own, before any backoff.
+_CLIENT = httpx.Client(
+    headers=IMPERSONATE_HEADERS,
+    timeout=120.0,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=20, max_connections=100, keepalive_expiry=60
+        ),
+        retries=3,
+    ),
+)
+atexit.register(_CLIENT.close)
+
+# Upper bound on concurrent requests issued against the shared client.
+MAX_WORKERS = 32
+
 
 @dataclass(eq=True, frozen=True)
 class Firmware:
@@ -49,8 +77,23 @@ class Firmware:
         return self.filename and self.download_url
 
 
-@total_ordering
+# Converter with a pre-generated structure hook for Firmware, reused for every list.
+converter = Converter()
+_structure_firmware = make_dict_structure_fn(Firmware, converter)
+converter.register_structure_hook(Firmware, _structure_firmware)
+
+
+def structure_fws(data: Iterable[dict]) -> list[Firmware]:
+    return [_structure_firmware(d, Firmware) for d in data]
+
+
 class Version:
+    # Bounds as (major, minor, patch). The components of _MAX_KEY double as the
+    # bases used to pack a version into an int.
+    _MIN_KEY = (0, 0, 0)
+    _MAX_KEY = (10, 20, 20)
+    _MAJOR_BASE, _MINOR_BASE, _PATCH_BASE = _MAX_KEY
+
     def __init__(self, val: Union[str, tuple[int, int, int]], unchecked: bool = False):
         if isinstance(val, str):
             tup = val.split(".", 3)
@@ -61,21 +104,22 @@ class Version:
             self.__major = val[0]
             self.__minor = val[1]
             self.__patch = val[2]
+        self.__key = (self.__major, self.__minor, self.__patch)
+        self.__int = (
+            self.__major * self._MINOR_BASE + self.__minor
+        ) * self._PATCH_BASE + self.__patch
 
         if not unchecked:
-            if self < Version.min():
+            if self.__key < self._MIN_KEY:
                 raise ValueError(f"Version must be >= {Version.min()}")
-            if self > Version.max():
+            if self.__key > self._MAX_KEY:
                 raise ValueError(f"Version must be <= {Version.max()}")
 
     @classmethod
     def from_int(cls, num: int) -> Version:
-        divpatch = cls.max().__patch
-        divminor = cls.max().__minor
-        divmajor = cls.max().__major
-        num, patch = (num // divpatch, num % divpatch)
-        num, minor = (num // divminor, num % divminor)
-        num, major = (num // divmajor, num % divmajor)
+        num, patch = divmod(num, cls._PATCH_BASE)
+        num, minor = divmod(num, cls._MINOR_BASE)
+        num, major = divmod(num, cls._MAJOR_BASE)
         if num != 0:
             raise ValueError("Overflowing number")
         return cls((major, minor, patch))
@@ -86,20 +130,14 @@ class Version:
 
     @classmethod
     def min(cls) -> Version:
-        return cls("0.0.0", unchecked=True)
+        return cls(cls._MIN_KEY, unchecked=True)
 
     @classmethod
     def max(cls) -> Version:
-        return cls("10.20.20", unchecked=True)
+        return cls(cls._MAX_KEY, unchecked=True)
 
     def __int__(self) -> int:
-        m = 1
-        v = self.__patch * m
-        m *= self.max().__patch
-        v += self.__minor * m
-        m *= self.max().__minor
-        v += self.__major * m
-        return v
+        return self.__int
 
     def __str__(self):
         return f"{self.__major}.{self.__minor}.{self.__patch}"
@@ -117,21 +155,25 @@ class Version:
         return Version.from_int(int(self) // int(other))
 
     def __eq__(self, other):
-        return (
-            self.__major == other.__major
-            and self.__minor == other.__minor
-            and self.__patch == other.__patch
-        )
+        return self.__key == other.__key
+
+    def __ne__(self, other):
+        return self.__key != other.__key
 
     def __lt__(self, other):
-        return (
-            self.__major < other.__major
-            or self.__minor < other.__minor
-            or self.__patch < other.__patch
-        )
+        return self.__key < other.__key
+
+    def __le__(self, other):
+        return self.__key <= other.__key
+
+    def __gt__(self, other):
+        return self.__key > other.__key
+
+    def __ge__(self, other):
+        return self.__key >= other.__key
 
     def __hash__(self):
-        return int(self)
+        return self.__int
 
 
 class VersionTests(unittest.TestCase):
@@ -150,6 +192,20 @@ class VersionTests(unittest.TestCase):
         v = a + b
         self.assertEqual(v, Version("3.5.7"))
 
+    def test_bounds(self):
+        self.assertEqual(Version.max(), Version("10.20.20"))
+        with self.assertRaises(ValueError):
+            Version("10.20.21")
+
+    def test_lt(self):
+        self.assertLess(Version("1.5.0"), Version("2.0.0"))
+        self.assertFalse(Version("2.0.0") < Version("1.5.0"))
+        self.assertFalse(Version("1.2.3") < Version("1.2.3"))
+        self.assertLessEqual(Version("1.2.3"), Version("1.2.3"))
+        self.assertGreater(Version("2.0.0"), Version("1.5.0"))
+        self.assertGreaterEqual(Version("2.0.0"), Version("2.0.0"))
+        self.assertNotEqual(Version("2.0.0"), Version("2.0.1"))
+
     def test_mid(self):
         a = Version("2.2.3")
         b = Version("10.20.20")
@@ -173,8 +229,11 @@ def niceprint(type: str, *values: object):
     console.print(prefix, *values)
 
 
+FW_FILENAME_RE = re.compile(r"(.*)(.)(\d+\.\d+\.\d+)(\..*)")
+
+
 def parse_fw_filename(s: str) -> tuple[str, str, Version, str]:
-    match = re.fullmatch(r"(.*)(.)(\d+\.\d+\.\d+)(\..*)", s)
+    match = FW_FILENAME_RE.fullmatch(s)
     name = match.group(1)
     sep = match.group(2)
     version_str = match.group(3)
@@ -182,106 +241,179 @@ def parse_fw_filename(s: str) -> tuple[str, str, Version, str]:
     return (name, sep, Version(version_str), ext)
 
 
-def sanitize_fws(iter: Iterable[Firmware]) -> Iterable[Firmware]:
-    return (fw for fw in sorted(iter, key=lambda x: x.filename) if fw.is_valid)
+def sanitize_fws(iter: Iterable[Firmware]) -> list[Firmware]:
+    return sorted(
+        (fw for fw in iter if fw.filename and fw.download_url),
+        key=attrgetter("filename"),
+    )
 
 
-@cache
-def http_request(method: str, url: str, retry: int | None = -1):
-    backoff = 10
-    max_backoff = 300
-    last_exception: Exception | None = None
-    while retry:
-        reqtext = f"Request {method} {url}"
-        try:
-            response = httpx.request(
-                method, url, headers=IMPERSONATE_HEADERS, timeout=120.0
-            )
-            response = httpx.get(url, headers=IMPERSONATE_HEADERS, timeout=120.0)
+def is_retryable(e: BaseException) -> bool:
+    if isinstance(e, HTTPStatusError):
+        match (e.response.status_code, e.response.headers.get("server")):
+            case (code, _) if code >= 500 and code <= 599:
+                return True
+            case (429, _):
+                return True
+            # Server responds with AkamaiGHost when rate limits or other problems are encountered.
+            case (403, "AkamaiGHost"):
+                return True
+            case _:
+                return False
+    return isinstance(e, HTTPError)
+
+
+_backoff = tenacity.wait_exponential_jitter(multiplier=10, max=300)
+
+
+def _wait(retry_state: tenacity.RetryCallState) -> float:
+    wait = _backoff(retry_state)
+    e = retry_state.outcome.exception()
+    if isinstance(e, HTTPStatusError):
+        retry_after = e.response.headers.get("retry-after", "")
+        if retry_after.isdigit():
+            wait = max(wait, float(retry_after))
+    return wait
+
+
+def retry_request(reqtext: str, send: Callable[[], T], retry: int | None = -1) -> T:
+    def log_error(retry_state: tenacity.RetryCallState):
+        match retry_state.outcome.exception():
+            case TimeoutException():
+                niceprint("ERROR", f"{reqtext}: Timeout")
+            case HTTPStatusError() as e:
+                niceprint(
+                    "ERROR", f"{reqtext}: HTTP Status Code {e.response.status_code}"
+                )
+            case e:
+                niceprint("ERROR", f"{reqtext}: {e}")
+
+    def log_retry(retry_state: tenacity.RetryCallState):
+        niceprint(
+            "INFO",
+            f"{reqtext}: Retrying request in {retry_state.next_action.sleep:.1f}s",
+        )
+
+    retrying = tenacity.Retrying(
+        stop=(
+            tenacity.stop_never
+            if retry is None or retry == -1
+            else tenacity.stop_after_attempt(retry)
+        ),
+        wait=_wait,
+        retry=tenacity.retry_if_exception(is_retryable),
+        after=log_error,
+        before_sleep=log_retry,
+        reraise=True,
+    )
+    result = retrying(send)
+    niceprint("OK", reqtext)
+    return result
+
+
+def http_request(method: str, url: str, retry: int | None = -1) -> bytes:
+    def send() -> bytes:
+        response = _CLIENT.request(method, url)
+        response.raise_for_status()
+        return response.read()
+
+    return retry_request(f"Request {method} {url}", send, retry)
+
+
+def http_stream(url: str, dest_path: Path, retry: int | None = -1):
+    # Write to a temporary file first so an interrupted download never leaves a
+    # partial file behind at dest_path.
+    part_path = dest_path.with_name(f"{dest_path.name}.part")
+
+    def send():
+        with _CLIENT.stream("GET", url) as response:
             response.raise_for_status()
-            niceprint("OK", reqtext)
-            return response.read()
-        except TimeoutException as e:
-            last_exception = e
-            niceprint("ERROR", f"{reqtext}: Timeout")
-        except HTTPStatusError as e:
-            last_exception = e
-            match (e.response.status_code, e.response.headers.get("server")):
-                case (code, _) if code >= 500 and code <= 599:
-                    pass
-                case 429:
-                    pass
-                # Server responds with AkamaiGHost when rate limits or other problems are encountered.
-                case 403, "AkamaiGHost":
-                    pass
-                case _:
-                    raise e
-            niceprint("ERROR", f"{reqtext}: HTTP Status Code {e.response.status_code}")
-        except HTTPError as e:
-            last_exception = e
-            niceprint("ERROR", f"{reqtext}: {e}")
-        if retry != -1:
-            retry -= 1
-        if retry:
-            niceprint("INFO", f"{reqtext}: Retrying request in {backoff}s")
-            time.sleep(backoff)
-            backoff = min(backoff * 2, max_backoff)
-    raise last_exception
+            fd = os.open(
+                part_path,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                0o644,
+            )
+            try:
+                for chunk in response.iter_bytes(chunk_size=1 << 16):
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(fd, view) :]
+                if hasattr(os, "posix_fadvise"):
+                    # Downloaded firmware is not read back, so keep it out of the page cache.
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        part_path.replace(dest_path)
+
+    try:
+        retry_request(f"Request GET {url}", send, retry)
+    finally:
+        part_path.unlink(missing_ok=True)
 
 
 def http_head(url: str, retry: int | None = -1) -> bool:
-    return http_request("HEAD", url, retry)
+    http_request("HEAD", url, retry)
+    return True
+
+
+@lru_cache(maxsize=1024)
+def _cached_get(url: str) -> bytes:
+    return http_request("GET", url)
 
 
 def http_get(url: str, retry: int | None = -1) -> bytes:
+    if retry == -1:
+        return _cached_get(url)
     return http_request("GET", url, retry)
 
 
-def get_firmware_list_json(version: str) -> str:
+@lru_cache(maxsize=None)
+def get_firmware_list_json(version: str) -> bytes:
     version_safe = quote(version)
     url = f"https://api.shimano.com/etube/firmware/{version_safe}"
-    return http_get(url).decode()
+    return http_get(url)
+
+
+@lru_cache(maxsize=None)
+def _parse_firmware_list(version: str) -> frozenset[Firmware]:
+    return frozenset(structure_fws(orjson.loads(get_firmware_list_json(version))))
 
 
 def get_firmware_list(version: str) -> list[Firmware]:
-    return list(
-        sanitize_fws(
-            cattr.structure(json.loads(get_firmware_list_json(version)), list[Firmware])
-        )
-    )
+    return sanitize_fws(structure_fws(orjson.loads(get_firmware_list_json(version))))
 
 
 def get_firmware_list_bisect() -> list[Firmware]:
     ver_min = Version("2.2.3")
     ver_max = Version("9.9.19")
-    with Progress(console=console) as progress:
+    with (
+        Progress(console=console) as progress,
+        ThreadPoolExecutor(max_workers=2) as executor,
+    ):
         task = progress.add_task("Searching for firmware", total=int(ver_max - ver_min))
 
-        def inner(low: Version, high: Version):
-            mid = Version.from_int((int(low) + int(high)) // 2)
+        fws: set[Firmware] = set()
+        intervals = deque([(ver_min, ver_max)])
+        while intervals:
+            low, high = intervals.popleft()
+            mid = Version.mid(low, high)
             final = low == mid or high == mid
 
             # Get all firmware using bisection
-            a = get_firmware_list_json(str(mid))
-            b = get_firmware_list_json(str(high))
+            a, b = executor.map(_parse_firmware_list, (str(mid), str(high)))
 
+            fws.update(a)
             if a == b:
                 progress.update(task, advance=int(high - mid))
-                return {a, *([] if final else inner(low, mid))}
+                if not final:
+                    intervals.append((low, mid))
             else:
-                dct = {a, b}
+                fws.update(b)
                 if not final:
-                    c = inner(low, mid)
-                    d = inner(mid, high)
-                    dct = dct.union(c).union(d)
-                return dct
+                    intervals.append((low, mid))
+                    intervals.append((mid, high))
 
-        json_fws_set = inner(ver_min, ver_max)
-        fws = set()
-        for json_fws in json_fws_set:
-            data = json.loads(json_fws)
-            fws = fws.union(cattr.structure(data, set[Firmware]))
-        return list(sanitize_fws(fws))
+        return sanitize_fws(fws)
 
 
 def firmware_scrape() -> dict[str, list[Version]]:
@@ -301,7 +433,7 @@ def firmware_scrape() -> dict[str, list[Version]]:
             html = http_get(url).decode()
             progress.update(fetch_task, advance=1)
             progress.refresh()
-            soup = BeautifulSoup(html, features="html.parser")
+            soup = BeautifulSoup(html, features="lxml")
             table = soup.select_one(".firmware-table")
             rows = table.select("tbody tr")
 
@@ -327,43 +459,55 @@ def get_all_firmware() -> list[Firmware]:
     niceprint("INFO", "Scraping website")
     scraped = firmware_scrape()
     scraped_models_norm = {name: name.replace("-", "") for name in scraped.keys()}
+    # (model, model_norm) pairs and the normalized names alone, in scraped order.
+    scraped_items = tuple(scraped_models_norm.items())
+    scraped_norms = tuple(model_norm for _, model_norm in scraped_items)
+
+    # Automaton over the scraped models, matching the first model (in scraped order)
+    # that is a substring of an API name.
+    models_automaton = ahocorasick.Automaton()
+    for index, (model, model_norm) in enumerate(scraped_items):
+        if model_norm and not models_automaton.exists(model_norm):
+            models_automaton.add_word(model_norm, (index, model))
+    models_automaton.make_automaton()
+
+    # Automaton over the API names, used to find the first scraped model that
+    # contains each API name.
+    names_automaton = ahocorasick.Automaton()
+    for name in fws_dict.keys():
+        if name:
+            names_automaton.add_word(name, name)
+    names_automaton.make_automaton()
+    rev_substr_models: dict[str, str] = dict()
+    if names_automaton.kind == ahocorasick.AHOCORASICK:
+        for model, model_norm in scraped_items:
+            for _, name in names_automaton.iter(model_norm):
+                rev_substr_models.setdefault(name, model)
+
     fw_name_models: dict[str, str] = dict()
     for name, fw in track(
         fws_dict.items(), description="Matching API <-> Scraped", console=console
     ):
-        result = next(
-            (
-                (model, f"substr ({model})")
-                for (model, model_norm) in scraped_models_norm.items()
-                if model_norm in name
-            ),
-            None,
-        ) or next(
-            (
-                (model, f"rev. substr ({model})")
-                for (model, model_norm) in scraped_models_norm.items()
-                if name in model_norm
-            ),
-            None,
+        substr = (
+            min((val for _, val in models_automaton.iter(name)), default=None)
+            if models_automaton.kind == ahocorasick.AHOCORASICK
+            else None
         )
+        if substr is not None:
+            result = (substr[1], f"substr ({substr[1]})")
+        elif name in rev_substr_models:
+            model = rev_substr_models[name]
+            result = (model, f"rev. substr ({model})")
+        else:
+            result = None
         (ok, (model, note)) = (result is not None, result if result else (None, None))
 
         if not ok:
-            val = max(
-                (
-                    (
-                        model,
-                        difflib.SequenceMatcher(None, name, model_norm).ratio(),
-                    )
-                    for (model, model_norm) in scraped_models_norm.items()
-                ),
-                key=lambda x: x[1],
-            )
-            (ok, model, note) = (
-                val[1] > 0.7,
-                val[0],
-                f"similar ({val[0]}, ratio: {val[1]})",
-            )
+            # Returns (model_norm, score, index) when given a sequence of choices.
+            val = process.extractOne(name, scraped_norms, scorer=fuzz.ratio)
+            if val is not None:
+                model = scraped_items[val[2]][0]
+                (ok, note) = (val[1] > 70, f"similar ({model}, ratio: {val[1] / 100})")
 
         if ok:
             fw_name_models[name] = model
@@ -375,9 +519,9 @@ def get_all_firmware() -> list[Firmware]:
     fws_all_set: set[Firmware] = set()
     for name, model in fw_name_models.items():
         name_fws = fws_dict[name]
-        for fw in name_fws:
-            fws_all_set.add(fw)
+        fws_all_set.update(name_fws)
         if model is not None:
+            fw = name_fws[-1]
             (basename, sep, version, ext) = parse_fw_filename(fw.filename)
             for version in scraped[model]:
                 filename = f"{basename}{sep}{version}{ext}"
@@ -392,20 +536,26 @@ def get_all_firmware() -> list[Firmware]:
                     )
                 )
 
-    niceprint("INFO", "Verifying firmware URLs")
-    fws_all: list[Firmware] = []
-    for fw in track(
-        sorted(fws_all_set, key=lambda x: x.filename),
-        description="Verifying firmware URLs",
-        console=console,
-    ):
+    def verify(fw: Firmware) -> Firmware | None:
         try:
             http_head(fw.download_url)
-            fws_all.append(fw)
+            return fw
         except HTTPStatusError as e:
             niceprint(
                 "WARN",
                 f"Ignoring firmware '{fw.filename}': HTTP Error {e.response.status_code}",
             )
+            return None
+
+    niceprint("INFO", "Verifying firmware URLs")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(
+            track(
+                executor.map(verify, sorted(fws_all_set, key=attrgetter("filename"))),
+                total=len(fws_all_set),
+                description="Verifying firmware URLs",
+                console=console,
+            )
+        )
 
-    return fws_all
+    return [fw for fw in results if fw is not None]
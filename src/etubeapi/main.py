@@ -11,16 +11,22 @@ from rich.progress import track
 from rich.table import Table
 from etubeapi.lib import (
     Firmware,
+    converter,
     get_firmware_list_bisect,
     get_firmware_list,
     get_all_firmware,
-    http_get,
+    http_stream,
     niceprint,
+    structure_fws,
     console,
 )
-import cattr
 import yaml
 
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
 app = typer.Typer(
     help="Operations for scraping and retrieving Shimano E-Tube firmware."
 )
@@ -54,7 +60,7 @@ def output_fws(fws: list[Firmware]):
             )
         console.print(table)
     else:
-        yaml.safe_dump(cattr.unstructure(fws), sys.stdout)
+        yaml.dump(converter.unstructure(fws), sys.stdout, Dumper=SafeDumper)
 
 
 @firmware_app.command("get")
@@ -86,7 +92,7 @@ def download_firmware(
     dir: Path, file: typer.FileText = sys.stdin, overwrite: bool = False
 ):
     """Downloads the firmware specified in stdin or --file."""
-    fws: list[Firmware] = cattr.structure(yaml.safe_load(file), list[Firmware])
+    fws: list[Firmware] = structure_fws(yaml.load(file, Loader=SafeLoader))
 
     dir.mkdir(parents=True, exist_ok=True)
     for i, fw in enumerate(
@@ -100,9 +106,7 @@ def download_firmware(
         if file.exists() and not overwrite:
             continue
         try:
-            data = http_get(fw.download_url)
-            with file.open("wb") as f:
-                f.write(data)
+            http_stream(fw.download_url, file)
         except HTTPStatusError as e:
             niceprint(
                 "WARN",